@@ -1,7 +1,12 @@
 import difflib
 import hashlib
+import os
 import re
+import time
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from typing import Any, Optional, Tuple, Union
 from urllib.parse import parse_qs, urlparse
 
@@ -23,11 +28,37 @@ from ..log import get_logger
 from .git_provider import MAX_FILES_ALLOWED_FULL, GitProvider
 
 
+# .gitmodules parsing: '[submodule "name"]' headers followed by 'key = value' lines
+_SUBMODULE_HEADER = re.compile(r'^\s*\[submodule\s+"([^"]+)"\]\s*$', re.I)
+_GITMODULES_KV = re.compile(r'^\s*(path|url|branch)\s*=\s*(.+?)\s*$', re.I)
+_GITMODULES_INLINE_COMMENT = re.compile(r'\s[#;].*$')
+
+# max number of decoded files kept by get_pr_file_content
+_FILE_CONTENT_CACHE_SIZE = 64
+# seconds a "not found" answer (missing file / unresolvable project) is remembered
+_NEGATIVE_CACHE_TTL = 30
+
+
+@dataclass(slots=True, frozen=True)
+class SubmoduleEntry:
+    """A submodule declared in '.gitmodules'."""
+    path: str
+    url: str
+    branch: Optional[str] = None
+
+
 class DiffNotFoundError(Exception):
     """Raised when the diff for a merge request cannot be found."""
     pass
 
 class GitLabProvider(GitProvider):
+    # GitProvider defines no __slots__, so instances keep a __dict__ for anything not listed here
+    __slots__ = (
+        "gitlab_url", "gl", "max_comment_chars", "id_project", "id_mr", "mr", "diff_files", "git_files",
+        "temp_comments", "pr_url", "RE_HUNK_HEADER", "incremental", "last_diff",
+        "_submodule_cache", "_gitmodules_cache", "_project_by_path_cache", "_projects_by_path", "_file_cache",
+        "_neg_cache",
+    )
 
     def __init__(self, merge_request_url: Optional[str] = None, incremental: Optional[bool] = False):
         gitlab_url = get_settings().get("GITLAB.URL", None)
@@ -70,18 +101,39 @@ class GitLabProvider(GitProvider):
         self.git_files = None
         self.temp_comments = []
         self._submodule_cache: dict[tuple[str, str, str], list[dict]] = {}
+        self._gitmodules_cache: dict[tuple[str, str], dict[str, SubmoduleEntry]] = {}
+        self._project_by_path_cache: dict[str, Any] = {}
+        self._projects_by_path: dict[str, Any] = {}
+        self._file_cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+        self._neg_cache: dict[tuple, float] = {}
         self.pr_url = merge_request_url
         self._set_merge_request(merge_request_url)
         self.RE_HUNK_HEADER = re.compile(
             r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@[ ]?(.*)")
         self.incremental = incremental
 
+    def _is_known_missing(self, key: tuple) -> bool:
+        expires_at = self._neg_cache.get(key)
+        if expires_at is None:
+            return False
+        if expires_at > time.monotonic():
+            return True
+        del self._neg_cache[key]
+        return False
+
+    def _remember_missing(self, key: tuple) -> None:
+        self._neg_cache[key] = time.monotonic() + _NEGATIVE_CACHE_TTL
+
     # --- submodule expansion helpers (opt-in) ---
-    def _get_gitmodules_map(self) -> dict[str, str]:
+    def _get_gitmodules_map(self) -> dict[str, SubmoduleEntry]:
         """
-        Return {submodule_path -> repo_url} from '.gitmodules' (best effort).
+        Return {submodule_path -> SubmoduleEntry} from '.gitmodules' (best effort).
         Tries target branch first, then source branch. Always returns text.
+        Results are cached per (project, target branch) for the provider's lifetime.
         """
+        key = (self.id_project, getattr(self.mr, "target_branch", None))
+        if key in self._gitmodules_cache:
+            return self._gitmodules_cache[key]
         try:
             proj = self.gl.projects.get(self.id_project)
         except Exception:
@@ -122,31 +174,33 @@ class GitLabProvider(GitProvider):
             or _read_text(getattr(self.mr, "source_branch", None))
         )
         if not content:
+            self._gitmodules_cache[key] = {}
             return {}
 
-        import configparser
-
-        parser = configparser.ConfigParser(
-            delimiters=("=",),
-            interpolation=None,
-            inline_comment_prefixes=("#", ";"),
-            strict=False,
-        )
-        try:
-            parser.read_string(content)
-        except Exception:
-            return {}
-
-        out: dict[str, str] = {}
-        for section in parser.sections():
-            if not section.lower().startswith("submodule"):
+        # single pass over the file; later keys in a section override earlier ones
+        sections: list[dict[str, str]] = []
+        section: dict[str, str] | None = None
+        for line in content.splitlines():
+            if _SUBMODULE_HEADER.match(line):
+                section = {}
+                sections.append(section)
+                continue
+            if line.lstrip().startswith("["):
+                # any other section ends the current submodule
+                section = None
                 continue
-            path = parser.get(section, "path", fallback=None)
-            url = parser.get(section, "url", fallback=None)
+            if section is None:
+                continue
+            kv = _GITMODULES_KV.match(_GITMODULES_INLINE_COMMENT.sub("", line))
+            if kv:
+                section[kv.group(1).lower()] = kv.group(2).strip().strip('"').strip("'")
+
+        out: dict[str, SubmoduleEntry] = {}
+        for section in sections:
+            path, url = section.get("path"), section.get("url")
             if path and url:
-                path = path.strip().strip('"').strip("'")
-                url = url.strip().strip('"').strip("'")
-                out[path] = url
+                out[path] = SubmoduleEntry(path=path, url=url, branch=section.get("branch"))
+        self._gitmodules_cache[key] = out
         return out
 
     def _url_to_project_path(self, url: str) -> str | None:
@@ -165,6 +219,24 @@ class GitLabProvider(GitProvider):
             return None
 
     def _project_by_path(self, proj_path: str):
+        """
+        Resolve a project by path. Hits are cached per path; misses only for _NEGATIVE_CACHE_TTL seconds.
+        Returns a project object or None.
+        """
+        if not proj_path:
+            return None
+        if proj_path in self._project_by_path_cache:
+            return self._project_by_path_cache[proj_path]
+        if self._is_known_missing(("project", proj_path)):
+            return None
+        project = self._resolve_project_by_path(proj_path)
+        if project is None:
+            self._remember_missing(("project", proj_path))
+        else:
+            self._project_by_path_cache[proj_path] = project
+        return project
+
+    def _resolve_project_by_path(self, proj_path: str):
         """
         Resolve a project by path with multiple strategies:
         1) URL-encoded path_with_namespace
@@ -172,9 +244,6 @@ class GitLabProvider(GitProvider):
         3) Search fallback + exact match on path_with_namespace (case-insensitive)
         Returns a project object or None.
         """
-        if not proj_path:
-            return None
-
         # 1) Encoded
         try:
             enc = urllib.parse.quote_plus(proj_path)
@@ -190,16 +259,22 @@ class GitLabProvider(GitProvider):
 
         # 3) Search fallback
         try:
-            name = proj_path.split("/")[-1]
-            # membership=True so we don't leak other people's repos
-            matches = self.gl.projects.list(search=name, simple=True, membership=True, per_page=100)
-            # prefer exact path_with_namespace match (case-insensitive)
-            for p in matches:
-                pwn = getattr(p, "path_with_namespace", "")
-                if pwn.lower() == proj_path.lower():
-                    return self.gl.projects.get(p.id)
-            if matches:
-                get_logger().warning(f"[submodule] no exact match for {proj_path} (skip)")
+            # search results are indexed by path_with_namespace (case-insensitive),
+            # so one listing can serve later lookups of other paths it returned
+            match = self._projects_by_path.get(proj_path.lower())
+            if match is None:
+                name = proj_path.split("/")[-1]
+                # membership=True so we don't leak other people's repos
+                matches = self.gl.projects.list(search=name, simple=True, membership=True, per_page=100)
+                for p in matches:
+                    pwn = getattr(p, "path_with_namespace", "")
+                    if pwn:
+                        self._projects_by_path.setdefault(pwn.lower(), p)
+                match = self._projects_by_path.get(proj_path.lower())
+                if match is None and matches:
+                    get_logger().warning(f"[submodule] no exact match for {proj_path} (skip)")
+            if match is not None:
+                return self.gl.projects.get(match.id)
         except Exception:
             pass
 
@@ -230,6 +305,29 @@ class GitLabProvider(GitProvider):
             self._submodule_cache[key] = []
             return []
 
+    def compare_submodules_bulk(self, items: list[tuple[str, str, str]]) -> dict[tuple[str, str, str], list[dict]]:
+        """
+        Compare several submodules concurrently.
+        Takes (proj_path, old_sha, new_sha) triples; returns {triple -> list of diffs}.
+        """
+        items = list(dict.fromkeys(items))
+        if not items:
+            return {}
+        if len(items) == 1:
+            return {items[0]: self._compare_submodule(*items[0])}
+
+        # stay within the HTTP session's connection pool so every worker reuses a
+        # kept-alive connection instead of opening (and TLS-negotiating) a new one
+        max_workers = min(len(items), max(4, (os.cpu_count() or 4) * 3 // 4),
+                          requests.adapters.DEFAULT_POOLSIZE)
+        results: dict[tuple[str, str, str], list[dict]] = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self._compare_submodule, *item): item for item in items}
+            for future in as_completed(futures):
+                # _compare_submodule soft-fails and never raises
+                results[futures[future]] = future.result()
+        return results
+
     def _expand_submodule_changes(self, changes: list[dict]) -> list[dict]:
         """
         If enabled, expand 'Subproject commit' bumps into real file diffs from the submodule.
@@ -245,7 +343,7 @@ class GitLabProvider(GitProvider):
         if not gitmodules:
             return changes
 
-        out = list(changes)
+        pending: list[tuple[str, tuple[str, str, str]]] = []
         for ch in changes:
             patch = ch.get("diff") or ""
             if "Subproject commit" not in patch:
@@ -259,7 +357,8 @@ class GitLabProvider(GitProvider):
             old_sha, new_sha = old_m.group(1), new_m.group(1)
 
             sub_path = ch.get("new_path") or ch.get("old_path") or ""
-            repo_url = gitmodules.get(sub_path)
+            entry = gitmodules.get(sub_path)
+            repo_url = entry.url if entry else None
             if not repo_url:
                 get_logger().warning(f"[submodule] no url for '{sub_path}' in .gitmodules (skip)")
                 continue
@@ -270,8 +369,12 @@ class GitLabProvider(GitProvider):
                 continue
 
             get_logger().info(f"[submodule] {sub_path} url={repo_url} -> proj_path={proj_path}")
-            sub_diffs = self._compare_submodule(proj_path, old_sha, new_sha)
-            for sd in sub_diffs:
+            pending.append((sub_path, (proj_path, old_sha, new_sha)))
+
+        compared = self.compare_submodules_bulk([item for _, item in pending])
+        out = list(changes)
+        for sub_path, item in pending:
+            for sd in compared.get(item, []):
                 sd_diff = sd.get("diff") or ""
                 sd_old = sd.get("old_path") or sd.get("a_path") or ""
                 sd_new = sd.get("new_path") or sd.get("b_path") or sd_old
@@ -347,20 +450,43 @@ class GitLabProvider(GitProvider):
             raise DiffNotFoundError(f"Could not get diff for merge request {self.id_mr}") from e
 
     def get_pr_file_content(self, file_path: str, branch: str) -> str:
+        key = (self.id_project, file_path, branch)
+        if key in self._file_cache:
+            self._file_cache.move_to_end(key)
+            return self._file_cache[key]
+        if self._is_known_missing(("file",) + key):
+            return ''
         try:
             file_obj = self.gl.projects.get(self.id_project).files.get(file_path, branch)
             content = file_obj.decode()
-            return decode_if_bytes(content)
+            # python-gitlab usually hands back bytes, but skip the decode chain when it's already text
+            if type(content) is not str:
+                content = decode_if_bytes(content)
         except GitlabGetError:
             # In case of file creation the method returns GitlabGetError (404 file not found).
             # In this case we return an empty string for the diff.
+            self._remember_missing(("file",) + key)
             return ''
         except Exception as e:
             get_logger().warning(f"Error retrieving file {file_path} from branch {branch}: {e}")
             return ''
+        self._file_cache[key] = content
+        if len(self._file_cache) > _FILE_CONTENT_CACHE_SIZE:
+            self._file_cache.popitem(last=False)
+        return content
+
+    @staticmethod
+    def _is_missing_file_error(e: GitlabUpdateError) -> bool:
+        # GitLab answers an update of a missing file with 400 "A file with this name doesn't exist"
+        if e.response_code == 404:
+            return True
+        message = str(e.error_message).lower()
+        return e.response_code == 400 and ("doesn't exist" in message or "does not exist" in message)
 
     def create_or_update_pr_file(self, file_path: str, branch: str, contents="", message="") -> None:
         """Create or update a file in the GitLab repository."""
+        self._file_cache.pop((self.id_project, file_path, branch), None)
+        self._neg_cache.pop(("file", self.id_project, file_path, branch), None)
         try:
             project = self.gl.projects.get(self.id_project)
 
@@ -368,12 +494,17 @@ class GitLabProvider(GitProvider):
                 action = "Update" if contents else "Create"
                 message = f"{action} {file_path}"
 
+            # try the common update case first, so an existing file costs a single request
             try:
-                existing_file = project.files.get(file_path, branch)
-                existing_file.content = contents
-                existing_file.save(branch=branch, commit_message=message)
+                project.files.update(file_path, {
+                    'branch': branch,
+                    'content': contents,
+                    'commit_message': message
+                })
                 get_logger().debug(f"Updated file {file_path} in branch {branch}")
-            except GitlabGetError:
+            except GitlabUpdateError as e:
+                if not self._is_missing_file_error(e):
+                    raise
                 project.files.create({
                     'file_path': file_path,
                     'branch': branch,
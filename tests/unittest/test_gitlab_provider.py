@@ -1,80 +1,158 @@
+import copy
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 from gitlab import Gitlab
-from gitlab.exceptions import GitlabGetError
-from gitlab.v4.objects import Project, ProjectFile
+from gitlab.exceptions import GitlabGetError, GitlabUpdateError
+from gitlab.v4.objects import Project
 
-from pr_agent.git_providers.gitlab_provider import GitLabProvider
+from pr_agent.git_providers.gitlab_provider import GitLabProvider, SubmoduleEntry
+
+_GITLAB_SETTINGS = {
+    "GITLAB.URL": "https://gitlab.com",
+    "GITLAB.PERSONAL_ACCESS_TOKEN": "fake_token",
+}
+
+_EXPECTED_PARAMS = ('file_path', 'branch', 'contents', 'message')
+# resolved once at import; 'self' is dropped to match the bound method
+_ACTUAL_PARAMS = tuple(inspect.signature(GitLabProvider.create_or_update_pr_file).parameters)[1:]
+
+
+class _StubFile:
+    """Minimal stand-in for a python-gitlab ProjectFile; cheaper than MagicMock(ProjectFile)."""
+    __slots__ = ("payload", "decode_calls")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.decode_calls = 0
+
+    def decode(self):
+        self.decode_calls += 1
+        return self.payload
 
 
 class TestGitLabProvider:
     """Test suite for GitLab provider functionality."""
 
-    @pytest.fixture
+    @pytest.fixture(scope="class")
     def mock_gitlab_client(self):
         client = MagicMock()
         return client
 
-    @pytest.fixture
+    @pytest.fixture(scope="class")
     def mock_project(self):
         project = MagicMock()
         return project
 
-    @pytest.fixture
-    def gitlab_provider(self, mock_gitlab_client, mock_project):
+    @pytest.fixture(scope="class")
+    def provider_prototype(self, mock_gitlab_client, mock_project):
+        """Build the provider once per class; each test works on a shallow copy of it."""
         with patch('pr_agent.git_providers.gitlab_provider.gitlab.Gitlab', return_value=mock_gitlab_client), \
              patch('pr_agent.git_providers.gitlab_provider.get_settings') as mock_settings:
 
-            mock_settings.return_value.get.side_effect = lambda key, default=None: {
-                "GITLAB.URL": "https://gitlab.com",
-                "GITLAB.PERSONAL_ACCESS_TOKEN": "fake_token"
-            }.get(key, default)
+            mock_settings.return_value.get = _GITLAB_SETTINGS.get
 
             mock_gitlab_client.projects.get.return_value = mock_project
             provider = GitLabProvider("https://gitlab.com/test/repo/-/merge_requests/1")
             provider.gl = mock_gitlab_client
             provider.id_project = "test/repo"
-            return provider
+            yield provider
+
+    @pytest.fixture
+    def gitlab_provider(self, provider_prototype, mock_gitlab_client, mock_project):
+        mock_gitlab_client.reset_mock(return_value=True, side_effect=True)
+        mock_project.reset_mock(return_value=True, side_effect=True)
+        mock_gitlab_client.projects.get.return_value = mock_project
+
+        provider = copy.copy(provider_prototype)
+        # the copy shares the prototype's caches, so empty them between tests
+        for cache in (provider._submodule_cache, provider._gitmodules_cache,
+                      provider._project_by_path_cache, provider._projects_by_path,
+                      provider._file_cache, provider._neg_cache):
+            cache.clear()
+        return provider
 
     def test_get_pr_file_content_success(self, gitlab_provider, mock_project):
-        mock_file = MagicMock(ProjectFile)
-        mock_file.decode.return_value = "# Changelog\n\n## v1.0.0\n- Initial release"
+        mock_file = _StubFile("# Changelog\n\n## v1.0.0\n- Initial release")
         mock_project.files.get.return_value = mock_file
 
         content = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
+        cached = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
 
-        assert content == "# Changelog\n\n## v1.0.0\n- Initial release"
+        assert content == cached == "# Changelog\n\n## v1.0.0\n- Initial release"
         mock_project.files.get.assert_called_once_with("CHANGELOG.md", "main")
-        mock_file.decode.assert_called_once()
+        assert mock_file.decode_calls == 1
 
     def test_get_pr_file_content_with_bytes(self, gitlab_provider, mock_project):
-        mock_file = MagicMock(ProjectFile)
-        mock_file.decode.return_value = b"# Changelog\n\n## v1.0.0\n- Initial release"
+        mock_file = _StubFile(b"# Changelog\n\n## v1.0.0\n- Initial release")
         mock_project.files.get.return_value = mock_file
 
         content = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
+        cached = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
+
+        assert content == cached == "# Changelog\n\n## v1.0.0\n- Initial release"
+        mock_project.files.get.assert_called_once_with("CHANGELOG.md", "main")
+
+    @pytest.mark.parametrize("exc,cached", [
+        (GitlabGetError("404 Not Found"), True),
+        (Exception("Network error"), False),
+        (ConnectionError("Connection reset"), False),
+    ])
+    def test_get_pr_file_content_errors(self, gitlab_provider, mock_project, exc, cached):
+        mock_project.files.get.side_effect = exc
 
-        assert content == "# Changelog\n\n## v1.0.0\n- Initial release"
+        assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "main") == ""
         mock_project.files.get.assert_called_once_with("CHANGELOG.md", "main")
 
-    def test_get_pr_file_content_file_not_found(self, gitlab_provider, mock_project):
+        # only a missing file is cached; other failures are retried
+        assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "main") == ""
+        assert mock_project.files.get.call_count == (1 if cached else 2)
+
+    def test_get_pr_file_content_not_found_expires(self, gitlab_provider, mock_project):
         mock_project.files.get.side_effect = GitlabGetError("404 Not Found")
 
-        content = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
+        with patch("pr_agent.git_providers.gitlab_provider.time.monotonic", return_value=1000.0) as m_time:
+            assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "main") == ""
+            m_time.return_value = 1029.0
+            assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "main") == ""
+            assert mock_project.files.get.call_count == 1
 
-        assert content == ""
-        mock_project.files.get.assert_called_once_with("CHANGELOG.md", "main")
+            # once the TTL has passed the file is looked up again
+            m_time.return_value = 1031.0
+            assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "main") == ""
+            assert mock_project.files.get.call_count == 2
+
+    def test_get_pr_file_content_cache_is_bounded(self, gitlab_provider, mock_project):
+        mock_file = _StubFile("content")
+        mock_project.files.get.return_value = mock_file
 
-    def test_get_pr_file_content_other_exception(self, gitlab_provider, mock_project):
-        mock_project.files.get.side_effect = Exception("Network error")
+        for i in range(65):
+            gitlab_provider.get_pr_file_content(f"file_{i}.md", "main")
+        assert len(gitlab_provider._file_cache) == 64
 
-        content = gitlab_provider.get_pr_file_content("CHANGELOG.md", "main")
+        # the oldest entry was evicted and is fetched again
+        gitlab_provider.get_pr_file_content("file_0.md", "main")
+        assert mock_project.files.get.call_count == 66
 
-        assert content == ""
+    def test_create_or_update_pr_file_invalidates_cache(self, gitlab_provider, mock_project):
+        mock_file = _StubFile("# Old changelog content")
+        mock_project.files.get.return_value = mock_file
+        gitlab_provider.get_pr_file_content("CHANGELOG.md", "feature-branch")
 
-    def test_create_or_update_pr_file_create_new(self, gitlab_provider, mock_project):
-        mock_project.files.get.side_effect = GitlabGetError("404 Not Found")
+        gitlab_provider.create_or_update_pr_file("CHANGELOG.md", "feature-branch", "# New", "Update")
+        mock_file.payload = "# New"
+
+        assert gitlab_provider.get_pr_file_content("CHANGELOG.md", "feature-branch") == "# New"
+
+    @pytest.mark.parametrize("update_error", [
+        GitlabUpdateError("404 Not Found", response_code=404),
+        GitlabUpdateError("A file with this name doesn't exist", response_code=400),
+    ])
+    def test_create_or_update_pr_file_create_new(self, gitlab_provider, mock_project, update_error):
+        mock_project.files.update.side_effect = update_error
         mock_file = MagicMock()
         mock_project.files.create.return_value = mock_file
 
@@ -85,7 +163,7 @@ class TestGitLabProvider:
             "CHANGELOG.md", "feature-branch", new_content, commit_message
         )
 
-        mock_project.files.get.assert_called_once_with("CHANGELOG.md", "feature-branch")
+        mock_project.files.update.assert_called_once()
         mock_project.files.create.assert_called_once_with({
             'file_path': 'CHANGELOG.md',
             'branch': 'feature-branch',
@@ -94,10 +172,6 @@ class TestGitLabProvider:
         })
 
     def test_create_or_update_pr_file_update_existing(self, gitlab_provider, mock_project):
-        mock_file = MagicMock(ProjectFile)
-        mock_file.decode.return_value = "# Old changelog content"
-        mock_project.files.get.return_value = mock_file
-
         new_content = "# New changelog content"
         commit_message = "Update CHANGELOG.md"
 
@@ -105,12 +179,25 @@ class TestGitLabProvider:
             "CHANGELOG.md", "feature-branch", new_content, commit_message
         )
 
-        mock_project.files.get.assert_called_once_with("CHANGELOG.md", "feature-branch")
-        mock_file.content = new_content
-        mock_file.save.assert_called_once_with(branch="feature-branch", commit_message=commit_message)
+        mock_project.files.update.assert_called_once_with("CHANGELOG.md", {
+            'branch': 'feature-branch',
+            'content': new_content,
+            'commit_message': commit_message,
+        })
+        mock_project.files.get.assert_not_called()
+        mock_project.files.create.assert_not_called()
+
+    def test_create_or_update_pr_file_update_rejected(self, gitlab_provider, mock_project):
+        mock_project.files.update.side_effect = GitlabUpdateError("403 Forbidden", response_code=403)
+
+        with pytest.raises(GitlabUpdateError):
+            gitlab_provider.create_or_update_pr_file(
+                "CHANGELOG.md", "feature-branch", "content", "message"
+            )
+        mock_project.files.create.assert_not_called()
 
     def test_create_or_update_pr_file_update_exception(self, gitlab_provider, mock_project):
-        mock_project.files.get.side_effect = Exception("Network error")
+        mock_project.files.update.side_effect = Exception("Network error")
 
         with pytest.raises(Exception):
             gitlab_provider.create_or_update_pr_file(
@@ -121,14 +208,8 @@ class TestGitLabProvider:
         assert hasattr(gitlab_provider, "create_or_update_pr_file")
         assert callable(getattr(gitlab_provider, "create_or_update_pr_file"))
 
-    def test_method_signature_compatibility(self, gitlab_provider):
-        import inspect
-
-        sig = inspect.signature(gitlab_provider.create_or_update_pr_file)
-        params = list(sig.parameters.keys())
-
-        expected_params = ['file_path', 'branch', 'contents', 'message']
-        assert params == expected_params
+    def test_method_signature_compatibility(self):
+        assert _ACTUAL_PARAMS == _EXPECTED_PARAMS
 
     @pytest.mark.parametrize("content,expected", [
         ("simple text", "simple text"),
@@ -139,8 +220,7 @@ class TestGitLabProvider:
         (b"unicode: caf\xc3\xa9", "unicode: café"),
     ])
     def test_content_encoding_handling(self, gitlab_provider, mock_project, content, expected):
-        mock_file = MagicMock(ProjectFile)
-        mock_file.decode.return_value = content
+        mock_file = _StubFile(content)
         mock_project.files.get.return_value = mock_file
 
         result = gitlab_provider.get_pr_file_content("test.md", "main")
@@ -152,23 +232,43 @@ class TestGitLabProvider:
         gitlab_provider.mr = MagicMock()
         gitlab_provider.mr.target_branch = "main"
 
-        file_obj = MagicMock(ProjectFile)
-        file_obj.decode.return_value = (
+        file_obj = _StubFile(
             "[submodule \"libs/a\"]\n"
             "    path = \"libs/a\"\n"
             "    url = \"https://gitlab.com/a.git\"\n"
             "[submodule \"libs/b\"]\n"
             "    path = libs/b\n"
             "    url = git@gitlab.com:b.git\n"
+            "    branch = develop\n"
         )
         mock_project.files.get.return_value = file_obj
         gitlab_provider.gl.projects.get.return_value = mock_project
 
         result = gitlab_provider._get_gitmodules_map()
         assert result == {
-            "libs/a": "https://gitlab.com/a.git",
-            "libs/b": "git@gitlab.com:b.git",
+            "libs/a": SubmoduleEntry(path="libs/a", url="https://gitlab.com/a.git"),
+            "libs/b": SubmoduleEntry(path="libs/b", url="git@gitlab.com:b.git", branch="develop"),
         }
+        assert result["libs/a"].url == "https://gitlab.com/a.git"
+
+    def test_get_gitmodules_map_cached(self, gitlab_provider, mock_project):
+        gitlab_provider.id_project = "1"
+        gitlab_provider.mr = MagicMock()
+        gitlab_provider.mr.target_branch = "main"
+
+        file_obj = _StubFile(
+            "[submodule \"libs/a\"]\n"
+            "    path = libs/a\n"
+            "    url = https://gitlab.com/a.git\n"
+        )
+        mock_project.files.get.return_value = file_obj
+        gitlab_provider.gl.projects.get.return_value = mock_project
+
+        first = gitlab_provider._get_gitmodules_map()
+        second = gitlab_provider._get_gitmodules_map()
+
+        assert first == second == {"libs/a": SubmoduleEntry(path="libs/a", url="https://gitlab.com/a.git")}
+        assert mock_project.files.get.call_count == 1
 
     def test_project_by_path_requires_exact_match(self, gitlab_provider):
         gitlab_provider.gl.projects.get.reset_mock()
@@ -182,6 +282,30 @@ class TestGitLabProvider:
         assert result is None
         assert gitlab_provider.gl.projects.get.call_count == 2
 
+        # the miss is cached, so a repeat lookup does not hit the API again
+        assert gitlab_provider._project_by_path("group/repo") is None
+        assert gitlab_provider.gl.projects.get.call_count == 2
+        gitlab_provider.gl.projects.list.assert_called_once()
+
+    def test_project_by_path_reuses_search_index(self, gitlab_provider):
+        fake = MagicMock()
+        fake.id = 42
+        fake.path_with_namespace = "other/group/repo"
+        found = MagicMock()
+
+        def get_project(project_id):
+            if project_id != 42:
+                raise Exception("not found")
+            return found
+
+        gitlab_provider.gl.projects.get.side_effect = get_project
+        gitlab_provider.gl.projects.list.return_value = [fake]
+
+        assert gitlab_provider._project_by_path("group/repo") is None
+        # the earlier listing already returned this path, so no new search is issued
+        assert gitlab_provider._project_by_path("Other/Group/Repo") is found
+        gitlab_provider.gl.projects.list.assert_called_once()
+
     def test_compare_submodule_cached(self, gitlab_provider):
         proj = MagicMock()
         proj.repository_compare.return_value = {"diffs": [{"diff": "d"}]}
@@ -192,3 +316,24 @@ class TestGitLabProvider:
         assert first == second == [{"diff": "d"}]
         m_pbp.assert_called_once_with("grp/repo")
         proj.repository_compare.assert_called_once_with("old", "new")
+
+    def test_compare_submodules_bulk(self, gitlab_provider):
+        items = [("grp/a", "o1", "n1"), ("grp/b", "o2", "n2"), ("grp/c", "o3", "n3")]
+        diffs = {item: [{"diff": item[0]}] for item in items}
+        with patch.object(gitlab_provider, "_compare_submodule",
+                          side_effect=lambda *item: diffs[item]) as m_cmp:
+            result = gitlab_provider.compare_submodules_bulk(items)
+
+        assert result == diffs
+        assert m_cmp.call_count == 3
+
+    def test_compare_submodules_bulk_fits_connection_pool(self, gitlab_provider):
+        items = [(f"grp/{i}", "old", "new") for i in range(32)]
+        with patch.object(gitlab_provider, "_compare_submodule", return_value=[]), \
+             patch("pr_agent.git_providers.gitlab_provider.os.cpu_count", return_value=64), \
+             patch("pr_agent.git_providers.gitlab_provider.ThreadPoolExecutor",
+                   wraps=ThreadPoolExecutor) as m_executor:
+            result = gitlab_provider.compare_submodules_bulk(items)
+
+        assert len(result) == 32
+        m_executor.assert_called_once_with(max_workers=requests.adapters.DEFAULT_POOLSIZE)